@@ -1,11 +1,17 @@
 
+import os
 import numpy as np
 import random
-import copy
-from collections import deque, namedtuple
-from baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
+from numba import njit
+
+# Settings for PyTorch's CUDA caching allocator. The learning step makes many small,
+# short-lived tensors, so round allocations up to a few power-of-2 size classes to keep
+# blocks reusable and avoid fragmentation. The allocator reads this the first time it is
+# used, so it has to be set before any network is built on the GPU
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "roundup_power2_divisions:4,max_split_size_mb:128")
 
 from networkModel import Actor, Critic, TD3Critic
+from segmentTree import SumSegmentTree, MinSegmentTree, updateTrees
 
 import torch
 #import torch.nn as nn
@@ -34,7 +40,28 @@ TRAIN_ACTOR_STEPS = 5 # was 2
 """ Parameter to control network soft updates"""
 TAU = 1e-3
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+""" Smallest batch size worth learning on the GPU. Below it the small networks spend their
+    time on kernel launches and host/device copies rather than math, and the CPU is faster
+"""
+MIN_GPU_BATCH_SIZE = 64
+
+device = torch.device("cuda:0" if torch.cuda.is_available() and BATCH_SIZE >= MIN_GPU_BATCH_SIZE else "cpu")
+if device.type == 'cpu':
+    # Leave half of the cores for the environment
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+
+""" Whether this PyTorch has the fused multi-tensor lerp used by the soft updates """
+HAS_FOREACH_LERP = hasattr(torch, '_foreach_lerp_')
+
+@torch.jit.script
+def td3_bootstrap(rewards: torch.Tensor, dones: torch.Tensor, Q_A: torch.Tensor, Q_B: torch.Tensor, \
+                  gamma: float) -> torch.Tensor:
+    '''
+    Q-targets for TD3 from the twin Critic values
+    Q_targets = R + γ * min(Q_A, Q_B) * (1 - dones)
+    Scripted so the min and the pointwise arithmetic can be fused into one kernel
+    '''
+    return rewards + gamma * torch.min(Q_A, Q_B) * (1.0 - dones)
 
 class Agent():
     '''
@@ -68,12 +95,12 @@ class Agent():
         # use .to(device) to specify the data type of the torch Tensor (for CPU or GPU)
         
         # Actor Networks
-        self.QNet_Actor_Local = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
-        self.QNet_Actor_Target = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
+        self.QNet_Actor_Local = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
+        self.QNet_Actor_Target = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
         
         # Critic Networks
-        self.QNet_Critic_Local = Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
-        self.QNet_Critic_Target = Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
+        self.QNet_Critic_Local = Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
+        self.QNet_Critic_Target = Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
         
         # Used to run the network for inference
         if fileName:
@@ -81,19 +108,33 @@ class Agent():
             self.QNet_Actor_Local.load_state_dict(weights)
             self.QNet_Actor_Target.load_state_dict(weights)
         
+        # TorchScript version of the local Actor used to pick actions every step. It shares
+        # its parameters with QNet_Actor_Local, so it always runs with the latest weights.
+        # It is only used for inference, so it can stay in eval mode
+        self.QNet_Actor_Scripted = self.QNet_Actor_Local.script().eval()
+        
+        # Cache the parameter lists used by the soft update so the networks
+        # aren't walked every learning step
+        self.actorTargetParams = list(self.QNet_Actor_Target.parameters())
+        self.actorLocalParams = list(self.QNet_Actor_Local.parameters())
+        self.criticTargetParams = list(self.QNet_Critic_Target.parameters())
+        self.criticLocalParams = list(self.QNet_Critic_Local.parameters())
+        
         # Set up the Optimizer for training the networks. Can set learning rate (i.e. gradient step size) 
-        # and apply momentum if desired
-        self.Optim_Actor = optim.Adam(self.QNet_Actor_Local.parameters(), lr=LEARN_RATE_ACTOR)
-        self.Optim_Critic = optim.Adam(self.QNet_Critic_Local.parameters(), lr=LEARN_RATE_CRITIC)
+        # and apply momentum if desired. On the GPU the fused Adam does the whole update
+        # in one kernel (the networks are already on the device at this point)
+        useFusedAdam = device.type == 'cuda'
+        self.Optim_Actor = optim.Adam(self.QNet_Actor_Local.parameters(), lr=LEARN_RATE_ACTOR, fused=useFusedAdam)
+        self.Optim_Critic = optim.Adam(self.QNet_Critic_Local.parameters(), lr=LEARN_RATE_CRITIC, fused=useFusedAdam)
         
         # Noise process (using Ornstein-Uhlenbeck process)
         # Used to encourage exploration so the Agent doesn't
-        # pick greedy actions every step
+        # pick greedy actions every step. Kept on the device with the Actor output
         self.noise = OUNoise(self.actionSize, random_seed)
         
         
         # Establish the Replay Buffer
-        self.replayMem = ReplayBuffer(random_seed)
+        self.replayMem = ReplayBuffer(self.stateSize, self.actionSize, random_seed)
         
     
     def step(self, state, action, reward, next_state, done):
@@ -113,24 +154,20 @@ class Agent():
         '''
         Returns the best guess of action values based on the current state of the NN
         '''
-        # Convert state to PyTorch tensor, make sure all values are a float
-        # .unsqueeze will reformat to dimensions with 1 at the specified dim (0 - row, 1 - column)
-        # .to(device) converts the tensor to the proper type for the device (CPU or GPU)
-        state = torch.from_numpy(state).float().unsqueeze(0).to(device)
-        
-        # Turn off Dropout Layers, Batch layers, etc. so we can run the network straight-through/without
-        # training mechanisms applied. Called eval mode
-        self.QNet_Actor_Local.eval()
+        # Convert state to a (1, stateSize) float tensor on the device. The Actor copies it
+        # into its preallocated (pinned on the GPU) buffer, so no new tensor is built every step
+        state = self.QNet_Actor_Local.formatState(state)
         
+        # The scripted Actor is held in eval mode, so no need to toggle train/eval here.
+        # Noise and clipping are applied on the device, so the action only has to be
+        # brought back to the CPU once
         with torch.no_grad():
-            actionVals = self.QNet_Actor_Local(state).cpu().data.numpy()
+            actionVals = self.QNet_Actor_Scripted(state)
+            if addNoise:
+                actionVals += self.noise.sample()
+            actionVals = torch.clamp(actionVals, -1, 1)
         
-        # Turn training mode back on
-        self.QNet_Actor_Local.train()
-        
-        if addNoise:
-            actionVals += self.noise.sample()
-        return np.clip(actionVals, -1, 1)
+        return actionVals.cpu().numpy()
         
     def learn(self, experiences):
         '''
@@ -181,18 +218,25 @@ class Agent():
         self.Optim_Actor.step()
         
         # ---------------------- Update Target Networks ------------------ #
-        self.softUpdate(self.QNet_Critic_Target, self.QNet_Critic_Local)
-        self.softUpdate(self.QNet_Actor_Target, self.QNet_Actor_Local)
+        self.softUpdate(self.criticTargetParams, self.criticLocalParams)
+        self.softUpdate(self.actorTargetParams, self.actorLocalParams)
         
-    def softUpdate(self, targetModel, localModel):
+    @torch.no_grad()
+    def softUpdate(self, targetParams, localParams):
         """
         Soft-update equation, called Polyak update
         θ_target = τ*θ_local + (1 - τ)*θ_target
-        Copies the parameters of the local network into the target network in small percentages
+        Copies the parameters of the local network into the target network in small percentages.
+        Takes the cached parameter lists of both networks so every parameter is updated
+        by a single fused lerp instead of one update per parameter
         """
         
-        for targetParams, localParams in zip(targetModel.parameters(), localModel.parameters()):
-            targetParams.data.copy_(TAU * localParams.data + (1.0 - TAU) * targetParams.data)
+        if HAS_FOREACH_LERP:
+            torch._foreach_lerp_(targetParams, localParams, TAU)
+        else:
+            # Older PyTorch: still one lerp per parameter instead of a mul, add and copy
+            for targetParam, localParam in zip(targetParams, localParams):
+                targetParam.lerp_(localParam, TAU)
 
 """ Parameter to control importance weights on replay probabilities
     0 -> no importance, 1 -> full importance
@@ -233,6 +277,18 @@ class TD3Agent():
         self.noiseRatio = 0.1
         self.noiseClipRatio = 0.5
         
+        # Action and noise bounds for the noisy target actions, built once on the device
+        self.actionMinArray = torch.full((self.actionSize,), float(self.actionBounds[0]), device=device)
+        self.actionMaxArray = torch.full((self.actionSize,), float(self.actionBounds[1]), device=device)
+        self.actionRange = self.actionMaxArray - self.actionMinArray
+        self.noiseMinArray = self.actionMinArray * self.noiseClipRatio
+        self.noiseMaxArray = self.actionMaxArray * self.noiseClipRatio
+        
+        # Seeded generator for the target policy smoothing noise. The networks no longer
+        # seed torch's global RNG, so the noise draws from its own stream
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(random_seed)
+        
         # PRNG seed
         self.seed = random.seed(random_seed)
         
@@ -244,12 +300,12 @@ class TD3Agent():
         # use .to(device) to specify the data type of the torch Tensor (for CPU or GPU)
         
         # Actor Networks
-        self.QNet_Actor_Local = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
-        self.QNet_Actor_Target = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
+        self.QNet_Actor_Local = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
+        self.QNet_Actor_Target = Actor(self.actionBounds, self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
         
         # Critic Networks
-        self.QNet_Critic_Local = TD3Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
-        self.QNet_Critic_Target = TD3Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300]).to(device)
+        self.QNet_Critic_Local = TD3Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
+        self.QNet_Critic_Target = TD3Critic(self.stateSize, self.actionSize, seed=random_seed, hiddenArray = [400, 300], device=device)
         
         # Used to run the network for inference
         if fileName:
@@ -257,26 +313,41 @@ class TD3Agent():
             self.QNet_Actor_Local.load_state_dict(weights)
             self.QNet_Actor_Target.load_state_dict(weights)
         
-        # Set up the Optimizer for training the networks. Can set learning rate (i.e. gradient step size) 
-        # and apply momentum if desired
-        self.Optim_Actor = optim.Adam(self.QNet_Actor_Local.parameters(), lr=LEARN_RATE_ACTOR)
-        self.Optim_Critic = optim.Adam(self.QNet_Critic_Local.parameters(), lr=LEARN_RATE_CRITIC)
+        # TorchScript version of the local Actor used to pick actions every step. It shares
+        # its parameters with QNet_Actor_Local, so it always runs with the latest weights.
+        # It is only used for inference, so it can stay in eval mode
+        self.QNet_Actor_Scripted = self.QNet_Actor_Local.script().eval()
         
-        # Noise process (using Ornstein-Uhlenbeck process)
-        # Used to encourage exploration so the Agent doesn't
-        # pick greedy actions every step
-        self.noise = OUNoise(self.actionSize, random_seed)
+        # TorchScript version of the local Critic, used for the A-network pass in the Actor
+        # loss. It also shares its parameters, so gradients land on QNet_Critic_Local
+        self.QNet_Critic_Scripted = self.QNet_Critic_Local.script()
+        
+        # Cache the parameter lists used by the soft update so the networks
+        # aren't walked every learning step
+        self.actorTargetParams = list(self.QNet_Actor_Target.parameters())
+        self.actorLocalParams = list(self.QNet_Actor_Local.parameters())
+        self.criticTargetParams = list(self.QNet_Critic_Target.parameters())
+        self.criticLocalParams = list(self.QNet_Critic_Local.parameters())
+        
+        # Set up the Optimizer for training the networks. Can set learning rate (i.e. gradient step size) 
+        # and apply momentum if desired. On the GPU the fused Adam does the whole update
+        # in one kernel (the networks are already on the device at this point)
+        useFusedAdam = device.type == 'cuda'
+        self.Optim_Actor = optim.Adam(self.QNet_Actor_Local.parameters(), lr=LEARN_RATE_ACTOR, fused=useFusedAdam)
+        self.Optim_Critic = optim.Adam(self.QNet_Critic_Local.parameters(), lr=LEARN_RATE_CRITIC, fused=useFusedAdam)
         
+        # Exploration noise comes from the action strategy, not an OU process
         
         # Establish the Replay Buffer
         if self.shouldUsePER:
             self.betaSchedule = np.linspace(BETA_INITIAL, BETA_FINAL, totalTimeSteps + 1)
-            self.replayMem = PrioritizedReplayBuffer(random_seed, alpha=0.6)
+            self.replayMem = PrioritizedReplayBuffer(self.stateSize, self.actionSize, random_seed, alpha=0.6)
         else:
-            self.replayMem = ReplayBuffer(random_seed)
+            self.replayMem = ReplayBuffer(self.stateSize, self.actionSize, random_seed)
         
-        # Choose which object will be used for choosing actions
-        self.actionStrategy = NormalNoiseDecayStrategy(self.actionBounds)
+        # Choose which object will be used for choosing actions. Its exploration noise gets
+        # a different seed than the smoothing noise, so the two streams aren't identical
+        self.actionStrategy = NormalNoiseDecayStrategy(self.actionBounds, seed=random_seed + 1)
         
     
     def step(self, state, action, reward, next_state, done):
@@ -300,16 +371,15 @@ class TD3Agent():
         '''
         Returns the best guess of action values based on the current state of the NN
         '''
-        # Convert state to PyTorch tensor, make sure all values are a float
-        # .unsqueeze will reformat to dimensions with 1 at the specified dim (0 - row, 1 - column)
-        # .to(device) converts the tensor to the proper type for the device (CPU or GPU)
-        state = torch.from_numpy(state).float().unsqueeze(0).to(device)
+        # Convert state to a (1, stateSize) float tensor on the device. The Actor copies it
+        # into its preallocated (pinned on the GPU) buffer, so no new tensor is built every step
+        state = self.QNet_Actor_Local.formatState(state)
         
         # Determine if agent should explore or exploit more often, based if there are a 
         # sufficient number of samples in the Replay Buffer
         minSamples = BUFFER_SIZE * 5
         shouldUseMaxExploration = len(self.replayMem) < minSamples
-        actionVals = self.actionStrategy.selectAction(self.QNet_Actor_Local, \
+        actionVals = self.actionStrategy.selectAction(self.QNet_Actor_Scripted, \
                      state, maxExploration = shouldUseMaxExploration, chooseGreedyAction = False)
          
         return np.clip(actionVals, -1, 1)
@@ -329,9 +399,11 @@ class TD3Agent():
         '''
         if self.shouldUsePER:
             states, actions, rewards, nextStates, dones, weights, batchIdx = experiences
+            # Importance-sampling weights go to the device once, shaped like the Q-values
+            weights = torch.as_tensor(weights, dtype=torch.float32, device=device).unsqueeze(1)
         else:
             states, actions, rewards, nextStates, dones = experiences
-            weights, batchIdx = np.ones_like(rewards), None
+            weights, batchIdx = None, None
         
         
         # -------------------------- Update Critic ---------------------- #
@@ -340,28 +412,32 @@ class TD3Agent():
             actionsNext = self.QNet_Actor_Target(nextStates)
             noisyActionsNext = self.actionNoise(actions, actionsNext)
             
-            # Get the minimum predicted value from the twin Critic nets
+            # Get the predicted values from the twin Critic nets
             Q_Targets_Next_A, Q_Targets_Next_B = self.QNet_Critic_Target(nextStates, noisyActionsNext)
-            Q_Targets_Next = torch.min(Q_Targets_Next_A, Q_Targets_Next_B)
         
-            # Compute the Q-targets from for the current states
-            # rewards = R + (Gamma * maximizing action reward * (1-dones)
-            Q_Targets = rewards + (GAMMA * Q_Targets_Next * (1 - dones))
+            # Compute the Q-targets from for the current states using the minimum of the twins
+            # rewards = R + (Gamma * minimum twin reward * (1-dones)
+            Q_Targets = td3_bootstrap(rewards, dones, Q_Targets_Next_A, Q_Targets_Next_B, GAMMA)
         
         # Get the expected Q-values from the Critic Local model using the current states
         Q_Expected_A, Q_Expected_B = self.QNet_Critic_Local(states, actions)
         
         if self.shouldUsePER:
-            tempQ_Target = Q_Targets.clone().detach()
-            tempQ_Expected_A = Q_Expected_A.clone().detach()
-            tdError = torch.mul(abs(tempQ_Target - tempQ_Expected_A) + PER_EPS, \
-                                     torch.from_numpy(weights).type(torch.FloatTensor))
-            self.replayMem.updatePriorities(batchIdx, tdError[0])
+            # New priorities from the TD error of the first twin. Everything stays on the
+            # device and is computed in place, and only the final errors come back to the CPU
+            with torch.no_grad():
+                tdError = (Q_Targets - Q_Expected_A).abs_().add_(PER_EPS).mul_(weights)
+            self.replayMem.updatePriorities(batchIdx, tdError.squeeze(1).cpu().numpy())
         
         
-        # Calculate the loss
-        criticLoss_A = F.mse_loss(Q_Expected_A, Q_Targets)
-        criticLoss_B = F.mse_loss(Q_Expected_B, Q_Targets)
+        # Calculate the loss. With PER, each sample's squared error is scaled by its
+        # importance-sampling weight
+        if self.shouldUsePER:
+            criticLoss_A = (weights * (Q_Expected_A - Q_Targets) ** 2).mean()
+            criticLoss_B = (weights * (Q_Expected_B - Q_Targets) ** 2).mean()
+        else:
+            criticLoss_A = F.mse_loss(Q_Expected_A, Q_Targets)
+            criticLoss_B = F.mse_loss(Q_Expected_B, Q_Targets)
         criticLoss = criticLoss_A + criticLoss_B
         
         # Minimize the loss
@@ -369,7 +445,7 @@ class TD3Agent():
         criticLoss.backward()
         
         # Clip the gradient return just to be safe...
-        torch.nn.utils.clip_grad_norm_(self.QNet_Critic_Local.parameters(), float('inf'))
+        torch.nn.utils.clip_grad_norm_(self.criticLocalParams, float('inf'))
         self.Optim_Critic.step()
         
         # -------------------------- Update Actor ----------------------- #
@@ -377,7 +453,7 @@ class TD3Agent():
         if self.stepNum % TRAIN_ACTOR_STEPS == 0:
             # Compute Actor loss
             actionsPredict = self.QNet_Actor_Local(states)
-            actorLoss = -self.QNet_Critic_Local.forwardNetA(states, actionsPredict).mean()
+            actorLoss = -self.QNet_Critic_Scripted.forwardNetA(states, actionsPredict).mean()
         
             # Minimize the loss
             self.Optim_Actor.zero_grad()
@@ -387,78 +463,94 @@ class TD3Agent():
         # ---------------------- Update Target Networks ------------------ #
         # Introduce a delay between updating Critic and Actor Target networks
         if self.stepNum % UPDATE_CRITIC_TARGET_STEPS == 0:
-            self.softUpdate(self.QNet_Critic_Target, self.QNet_Critic_Local)
+            self.softUpdate(self.criticTargetParams, self.criticLocalParams)
         if self.stepNum % UPDATE_ACTOR_TARGET_STEPS == 0:
-            self.softUpdate(self.QNet_Actor_Target, self.QNet_Actor_Local)
+            self.softUpdate(self.actorTargetParams, self.actorLocalParams)
         
-    def softUpdate(self, targetModel, localModel):
+    @torch.no_grad()
+    def softUpdate(self, targetParams, localParams):
         """
         Soft-update equation, called Polyak update
         θ_target = τ*θ_local + (1 - τ)*θ_target
-        Copies the parameters of the local network into the target network in small percentages
+        Copies the parameters of the local network into the target network in small percentages.
+        Takes the cached parameter lists of both networks so every parameter is updated
+        by a single fused lerp instead of one update per parameter
         """
         
-        for targetParams, localParams in zip(targetModel.parameters(), localModel.parameters()):
-            targetParams.data.copy_(TAU * localParams.data + (1.0 - TAU) * targetParams.data)
+        if HAS_FOREACH_LERP:
+            torch._foreach_lerp_(targetParams, localParams, TAU)
+        else:
+            # Older PyTorch: still one lerp per parameter instead of a mul, add and copy
+            for targetParam, localParam in zip(targetParams, localParams):
+                targetParam.lerp_(localParam, TAU)
     
     def actionNoise(self, prevActions, nextActions):
-        actionMin = self.actionBounds[0]
-        actionMax = self.actionBounds[1]
-        actionMinArray = (torch.from_numpy(np.ones(self.actionSize) * \
-                                           actionMin)).type(torch.FloatTensor)
-        actionMaxArray = (torch.from_numpy(np.ones(self.actionSize) * \
-                                           actionMax)).type(torch.FloatTensor)
-        
-        actionRange = actionMaxArray - actionMinArray
-        actionNoise = torch.randn_like(prevActions)  * self.noiseRatio * actionRange
-        noiseMin = actionMinArray * self.noiseClipRatio
-        noiseMax = actionMaxArray * self.noiseClipRatio
-        actionNoise = torch.max(torch.min(actionNoise, noiseMax), noiseMin)
-        
-        noisyNextActions = nextActions + actionNoise
-        noisyAction = torch.max(torch.min(noisyNextActions, actionMaxArray), actionMinArray)
+        # Bounds are cached on the device in __init__, and the noise is scaled and
+        # clipped in place
+        actionNoise = torch.randn(prevActions.shape, generator=self.generator, device=device)
+        actionNoise.mul_(self.noiseRatio).mul_(self.actionRange)
+        actionNoise.clamp_(self.noiseMinArray, self.noiseMaxArray)
+        
+        noisyAction = (nextActions + actionNoise).clamp_(self.actionMinArray, self.actionMaxArray)
         
         return noisyAction
         
 class OUNoise:
-    '''Ornstein-Uhlenbeck Noise Process '''
+    '''Ornstein-Uhlenbeck Noise Process, kept as a tensor on the device '''
     
     def __init__(self, size, seed, mu = 0.0, theta = 0.15, sigma = 0.2):
         ''' 
         Initialization parameters taken from CONTINUOUS CONTROL WITH DEEP REINFORCEMENT
         LEARNING paper
         Sampling the OU process can be described with an ODE
-        dot_x = theta * (mu - x) + sigma
+        dot_x = theta * (mu - x) + sigma * N(0, 1)
+        The state lives on the device, so the noise can be added to the network output
+        without a round trip through the CPU
         '''
-        self.mu = mu * np.ones(size)
+        self.mu = torch.full((size,), mu, device=device)
         self.theta = theta
         self.sigma = sigma
-        self.state = None
-        self.seed = random.seed(seed)
+        self.state = torch.empty(size, device=device)
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+        self.noiseBuff = torch.empty(size, device=device)
         self.reset()
     
     def reset(self):
         '''
         Reset the internal state to the mean, mu
-        Requires package 'copy'
         '''
-        self.state = copy.copy(self.mu)
+        self.state.copy_(self.mu)
         
     def sample(self):
         '''
-        Update the internal state and return it as a noise sample
+        Update the internal state in place and return it as a noise sample
+        x + theta * (mu - x) is a lerp from x towards mu by theta
         '''
-        x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * \
-            np.array([random.random() for i in range(len(x))])
-        self.state = x + dx
+        self.noiseBuff.normal_(generator=self.generator)
+        self.state.lerp_(self.mu, self.theta).add_(self.noiseBuff, alpha=self.sigma)
         return self.state
 
+@njit(cache=True)
+def _noiseRatioDecay(step, decaySteps, initNoiseRatio, minNoiseRatio):
+    '''
+    Linearly decay the noise ratio from initNoiseRatio to minNoiseRatio over decaySteps
+    '''
+    noiseRatio = 1.0 - step / decaySteps
+    noiseRatio = (initNoiseRatio - minNoiseRatio) * noiseRatio + minNoiseRatio
+    return min(max(noiseRatio, minNoiseRatio), initNoiseRatio)
+
 class NormalNoiseDecayStrategy():
-    def __init__(self, bounds, initialNoiseRatio = 0.5, minNoiseRatio = 0.1, decaySteps = 10000):
+    def __init__(self, bounds, initialNoiseRatio = 0.5, minNoiseRatio = 0.1, decaySteps = 10000, seed = None):
         '''
         bounds: usually the action bounds
+        seed: seed of the generator the exploration noise is drawn from (random if None)
         '''
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
         self.step = 0
         self.low = bounds[0]
         self.high = bounds[1]
@@ -468,11 +560,8 @@ class NormalNoiseDecayStrategy():
         self.ratioNoiseInjected = 0
     
     def noiseRatioUpdate(self):
-        noiseRatio = 1 - self.step / self.decaySteps
-        
-        # Scale the noise ratio
-        noiseRatio = (self.initNoiseRatio - self.minNoiseRatio) * noiseRatio + self.minNoiseRatio
-        noiseRatio = np.clip(noiseRatio, self.minNoiseRatio, self.initNoiseRatio)
+        # Scale the noise ratio, clipped to the initial and minimum ratios
+        noiseRatio = _noiseRatioDecay(self.step, self.decaySteps, self.initNoiseRatio, self.minNoiseRatio)
         
         self.step += 1
         
@@ -484,22 +573,26 @@ class NormalNoiseDecayStrategy():
         else:
             noiseScale = self.noiseRatio * self.high
         
-        network.eval()
+        # The networks have no Dropout or BatchNorm layers, so there is no need
+        # to switch between eval and train mode around inference. Noise and
+        # clipping are done on the device, and only the result comes back to the CPU
         with torch.no_grad():
-            greedyAction = network(state).cpu().detach().data.numpy().squeeze()
-        network.train()
+            greedyAction = network(state).squeeze()
         
         if chooseGreedyAction:
             self.ratioNoiseInjected = 0
-            return np.clip(greedyAction, self.low, self.high)
+            return torch.clamp(greedyAction, self.low, self.high).cpu().numpy()
         
-        noise = np.random.normal(loc=0, scale=noiseScale, size=len(greedyAction))
+        noise = torch.randn(greedyAction.shape, generator=self.generator, device=device) * noiseScale
         
         noisyAction = greedyAction + noise
-        action = np.clip(noisyAction, self.low, self.high)
+        action = torch.clamp(noisyAction, self.low, self.high)
         
         self.noiseRatio = self.noiseRatioUpdate()
         
+        # Bring the greedy and noisy actions back together in a single copy
+        greedyAction, action = torch.stack((greedyAction, action)).cpu().numpy()
+        
         # Used to inject noise into other steps of the process
         self.ratioNoiseInjected = np.mean(abs((greedyAction - action)/(self.high - self.low)))
 
@@ -523,51 +616,96 @@ class GreedyStrategy():
 
 class ReplayBuffer():
     '''
-    Structure to keep track of previous state, action pairs for Experience Replay
+    Structure to keep track of previous state, action pairs for Experience Replay.
+    Each field of an experience is kept in its own preallocated array, and the
+    arrays are written to as a ring buffer so a batch can be pulled out with a
+    single fancy-index per field
     
     Methods
     memAdd: store a memory in the buffer
     memSample: sample a memory from the buffer
     '''
     
-    def __init__(self, seed):
-        self.memBuff = deque(maxlen = BUFFER_SIZE)
+    def __init__(self, stateSize, actionSize, seed):
         self.batchSize = BATCH_SIZE
-        self.experience = namedtuple("Experience", field_names = ["state", "action", "reward", "nextState", "done"])
-        self.seed = random.seed(seed)
         
-    def addMem(self, state, action, reward, nextState, done):
-        # Store the data in an experience tuple
-        e = self.experience(state, action, reward, nextState, done)
+        # Generator used to draw the sample indexes
+        self.rng = np.random.default_rng(seed)
+        
+        # Contiguous storage for every field of the experience tuples
+        self.states = np.empty((BUFFER_SIZE, stateSize), dtype=np.float32)
+        self.actions = np.empty((BUFFER_SIZE, actionSize), dtype=np.float32)
+        self.rewards = np.empty((BUFFER_SIZE, 1), dtype=np.float32)
+        self.nextStates = np.empty((BUFFER_SIZE, stateSize), dtype=np.float32)
+        self.dones = np.empty((BUFFER_SIZE, 1), dtype=np.uint8)
         
-        # Add the tuple to the buffer
-        self.memBuff.append(e)
+        # Position of the next write, and how many memories are stored
+        self.nextIdx = 0
+        self.memCount = 0
+        
+        # Staging tensors that a sampled batch is gathered into before it is sent
+        # to the device. On the GPU these are page-locked so the copy can run
+        # asynchronously, and an event marks when the last copy out of them is done
+        pinMemory = device.type == 'cuda'
+        self.statesStage = torch.empty((BATCH_SIZE, stateSize), dtype=torch.float32, pin_memory=pinMemory)
+        self.actionsStage = torch.empty((BATCH_SIZE, actionSize), dtype=torch.float32, pin_memory=pinMemory)
+        self.rewardsStage = torch.empty((BATCH_SIZE, 1), dtype=torch.float32, pin_memory=pinMemory)
+        self.nextStatesStage = torch.empty((BATCH_SIZE, stateSize), dtype=torch.float32, pin_memory=pinMemory)
+        self.donesStage = torch.empty((BATCH_SIZE, 1), dtype=torch.uint8, pin_memory=pinMemory)
+        self.stageEvent = torch.cuda.Event() if pinMemory else None
+        
+    def addMem(self, state, action, reward, nextState, done):
+        # Write the data in place at the current position of the ring buffer
+        self.states[self.nextIdx] = state
+        self.actions[self.nextIdx] = action
+        self.rewards[self.nextIdx] = reward
+        self.nextStates[self.nextIdx] = nextState
+        self.dones[self.nextIdx] = done
+        
+        # Advance the write position, overwriting the oldest memory once full
+        self.nextIdx = (self.nextIdx + 1) % BUFFER_SIZE
+        self.memCount = min(self.memCount + 1, BUFFER_SIZE)
     
     def memSample(self):
         # Choose a random sample of memory from the Replay Buffer
-        memorySample = random.sample(self.memBuff, k=self.batchSize)
-        
-        # Separate the sample into constituent parts
-        states = torch.from_numpy(np.vstack([mem.state for mem in memorySample if mem is not \
-                                             None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([mem.action for mem in memorySample if mem is not \
-                                              None])).float().to(device)
-        rewards = torch.from_numpy(np.vstack([mem.reward for mem in memorySample if mem is not \
-                                              None])).float().to(device)
-        nextStates = torch.from_numpy(np.vstack([mem.nextState for mem in memorySample if mem is not \
-                                                 None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([mem.done for mem in memorySample if mem is not \
-                                            None]).astype(np.uint8)).float().to(device)
+        idx = self.rng.integers(0, self.memCount, size=self.batchSize)
+        return self.encodedSample(idx)
+    
+    def encodedSample(self, idxes):
+        '''
+        Gather the memories at idxes into the staging tensors and send them to the device
+        Note: on the CPU the returned tensors are the staging tensors themselves, so they
+        are only valid until the next sample is taken
+        '''
+        # Don't overwrite the staging tensors while the previous batch is still being copied
+        if self.stageEvent is not None:
+            self.stageEvent.synchronize()
+        
+        # Pull every field of the sample out of its array in one go
+        np.take(self.states, idxes, axis=0, out=self.statesStage.numpy())
+        np.take(self.actions, idxes, axis=0, out=self.actionsStage.numpy())
+        np.take(self.rewards, idxes, axis=0, out=self.rewardsStage.numpy())
+        np.take(self.nextStates, idxes, axis=0, out=self.nextStatesStage.numpy())
+        np.take(self.dones, idxes, axis=0, out=self.donesStage.numpy())
+        
+        states = self.statesStage.to(device, non_blocking=True)
+        actions = self.actionsStage.to(device, non_blocking=True)
+        rewards = self.rewardsStage.to(device, non_blocking=True)
+        nextStates = self.nextStatesStage.to(device, non_blocking=True)
+        dones = self.donesStage.to(device, non_blocking=True).float()
+        
+        if self.stageEvent is not None:
+            self.stageEvent.record()
   
         return (states, actions, rewards, nextStates, dones)
 
     def __len__(self):
         # Convenience function for returning the length of the buffer
-        return len(self.memBuff)
+        return self.memCount
 
 class PrioritizedReplayBuffer(ReplayBuffer):
-    def __init__(self, seed, alpha=0.5):
-        super(PrioritizedReplayBuffer, self).__init__(seed)
+    def __init__(self, stateSize, actionSize, seed, alpha=0.5):
+        super(PrioritizedReplayBuffer, self).__init__(stateSize, actionSize, seed)
         self.alpha = alpha
         capacity = 1
         
@@ -577,84 +715,48 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self.sumTree = SumSegmentTree(capacity)
         self.minTree = MinSegmentTree(capacity)
         self.maxPriority = 1.0
-        self.nextIdx = 0
         
     def addMem(self, *args, **kwargs):
         idx = self.nextIdx
         super().addMem(*args, **kwargs)
         self.sumTree[idx] = self.maxPriority ** self.alpha
         self.minTree[idx] = self.maxPriority ** self.alpha
-        
-        self.nextIdx = (self.nextIdx + 1) % BUFFER_SIZE
    
     def sampleProportional(self):
-        result = []
-        probTotal = self.sumTree.sum(0, len(self.memBuff) - 1)
+        probTotal = self.sumTree.sum()
         everyRangeLen = probTotal/BATCH_SIZE
         
-        for i in range(BATCH_SIZE):
-            mass = random.random() * everyRangeLen + i * everyRangeLen
-            idx = self.sumTree.find_prefixsum_idx(mass)
-            result.append(idx)
-        return result
-    
-    def encodedSample(self, idxes):
-        states = []
-        actions = []
-        rewards = []
-        nextStates = []
-        dones = []
-        for idx, count in zip(idxes, range(len(idxes))):
-            sampleChoice = self.memBuff[idx]
-            if sampleChoice is not None:
-                states.append(sampleChoice.state)
-                actions.append(sampleChoice.action)
-                rewards.append(sampleChoice.reward)
-                nextStates.append(sampleChoice.nextState)
-                dones.append(sampleChoice.done)
-                #states[(count,0)] = sampleChoice.state
-                #actions[count] = sampleChoice.action
-                #rewards[count] = sampleChoice.reward
-                #nextStates[count] = sampleChoice.nextState
-                #dones[count] = sampleChoice.done
-                
-        #states = torch.tensor(states).float().to(device)
-        #actions = torch.tensor(actions).float().to(device)
-        #rewards = torch.tensor(rewards).float().to(device)
-        #nextStates = torch.tensor(nextStates).float().to(device)
-        #dones = torch.tensor(dones).float().to(device)
-        
-        # Need to use unsqueeze because need an extra 1 in the dimensions for rewards and dones
-        states = torch.from_numpy(np.array(states)).float().to(device)
-        actions = torch.from_numpy(np.array(actions)).float().to(device)
-        rewards = torch.from_numpy(np.array(rewards)).float().to(device).unsqueeze(1)
-        nextStates = torch.from_numpy(np.array(nextStates)).float().to(device)
-        dones = torch.from_numpy(np.array(dones).astype(np.uint8)).float().to(device).unsqueeze(1)
+        # Draw one mass uniformly from each of the BATCH_SIZE equal ranges of the total,
+        # and look all of them up in the tree in one call
+        masses = (np.arange(BATCH_SIZE) + self.rng.random(BATCH_SIZE)) * everyRangeLen
+        result = self.sumTree.find_prefixsum_idx(masses)
         
-        return (states, actions, rewards, nextStates, dones)
+        # Rounding in the tree can walk a mass just past the newest memory into an
+        # empty leaf, so keep the indexes inside the filled part of the buffer
+        return np.minimum(result, len(self) - 1, out=result)
     
     def memSample(self, beta=0.5):
         indexes = self.sampleProportional()
         
-        weights = []
-        probMin = self.minTree.min() / self.sumTree.sum()
-        maxWeight = (probMin * len(self.memBuff)) ** (-beta)
-        
-        for idx in indexes:
-            probSample = self.sumTree[idx] / self.sumTree.sum()
-            weight = (probSample * len(self.memBuff)) ** (-beta)
-            weights.append(weight / maxWeight)
-        weights = np.array(weights)
-        encodedSampleReturn = self.encodedSample(indexes)
-        return tuple(list(encodedSampleReturn) + [weights, indexes])
+        # Importance-sampling weights, normalized by the largest possible weight
+        probTotal = self.sumTree.sum()
+        probMin = self.minTree.min() / probTotal
+        maxWeight = (probMin * len(self)) ** (-beta)
+        
+        probSamples = self.sumTree[indexes] / probTotal
+        weights = (probSamples * len(self)) ** (-beta) / maxWeight
+        
+        # The batch is gathered straight out of the buffer arrays with the same indexes
+        return self.encodedSample(indexes) + (weights, indexes)
     
     def updatePriorities(self, indexes, priorities):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
         assert len(indexes) == len(priorities)
-
-        for idx, priority in zip(indexes, priorities):
-            assert priority > 0
-            assert 0 <= idx < len(self.memBuff)
-            self.sumTree[idx] = priority ** self.alpha
-            self.minTree[idx] = priority ** self.alpha
-            
-            self.maxPriority = max(self.maxPriority, priority)
\ No newline at end of file
+        assert np.all(priorities > 0)
+        assert np.all((0 <= indexes) & (indexes < len(self)))
+        
+        # Both trees are updated for the whole batch in one compiled call
+        updateTrees(self.sumTree, self.minTree, indexes, priorities ** self.alpha)
+        
+        self.maxPriority = max(self.maxPriority, priorities.max())
\ No newline at end of file
@@ -1,123 +1,389 @@
 import numpy as np
+from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-def hidden_init(layer):
-    '''
-    Function that calculates the upper and lower limits for the
-    hidden layer weight initialization. Limits are used to
-    bound a uniform distribution so weights are not saturated
-    or close to zero when the network starts to learn.
-    This uses Xaviar initialization, which is useful for tanh
-    activation functions
-    '''
-    fan_in = layer.weight.data.size()[0]
-    fan_out = layer.weight.data.size()[1]
-    lim = np.sqrt(6.0)/ np.sqrt(fan_in + fan_out)
-    return (-lim, lim)
+""" Device the networks are built on when the caller doesn't pass one, probed once at import """
+_DEFAULT_DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+def _warmUp(scripted, *dummyInputs):
+    '''
+    Runs a freshly scripted network twice on dummy inputs. The profiling executor
+    compiles and optimizes the graph over the first calls, so this moves that cost
+    out of the first real steps
+    '''
+    with torch.no_grad():
+        for _ in range(2):
+            scripted(*dummyInputs)
+    return scripted
+
+def _mlp(sizes, layer=nn.Linear, device=None):
+    '''
+    Builds the layer stack shared by the networks: a layer between each pair of
+    consecutive sizes with a ReLU after every one but the last
+    '''
+    layers = []
+    for inSize, outSize in zip(sizes[:-1], sizes[1:]):
+        layers.extend([layer(inSize, outSize, device=device), nn.ReLU(inplace=True)])
+    return nn.Sequential(*layers[:-1])
+
+@torch.jit.script
+def _tanh_rescale(x: torch.Tensor, scale: torch.Tensor, bias: torch.Tensor) -> torch.Tensor:
+    '''
+    Output activation of the Actor followed by the affine rescale to the action limits
+    '''
+    return torch.addcmul(bias, torch.tanh(x), scale)
+
+def _freezeForInference(module, dummyInputs, preservedMethods=()):
+    '''
+    Scripts the module in eval mode and freezes it, folding the weights into the graph as
+    constants. On the CPU this goes through optimize_for_inference, which also lets
+    oneDNN pick its packed weight layouts up front. The frozen copy is a snapshot, it
+    doesn't see later training updates
+    '''
+    scripted = torch.jit.script(module).eval()
+    if next(module.parameters()).device.type == 'cpu':
+        frozen = torch.jit.optimize_for_inference(scripted, other_methods=list(preservedMethods))
+    else:
+        frozen = torch.jit.freeze(scripted, preserved_attrs=list(preservedMethods))
+    return _warmUp(frozen, *dummyInputs)
+
+def _captureGraph(function, *exampleInputs):
+    '''
+    Records one no_grad call of function on copies of the example inputs into a CUDA graph.
+    The call is warmed up on a side stream first, as graph capture requires. Returns the
+    graph with its static inputs and outputs: copying new values into the inputs and
+    replaying the graph refreshes the outputs in place
+    '''
+    staticInputs = tuple(x.detach().clone() for x in exampleInputs)
+    
+    sideStream = torch.cuda.Stream()
+    sideStream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(sideStream), torch.no_grad():
+        for _ in range(3):
+            function(*staticInputs)
+    torch.cuda.current_stream().wait_stream(sideStream)
+    
+    graph = torch.cuda.CUDAGraph()
+    with torch.no_grad(), torch.cuda.graph(graph):
+        staticOutputs = function(*staticInputs)
+    return graph, staticInputs, staticOutputs
+
+class _AutocastInference():
+    '''
+    Callable that runs a network under bf16 autocast and hands back fp32 outputs.
+    It is not a Module, so it has no state of its own and module calls like .eval()
+    or state_dict() can't reach the network being trained
+    '''
+    
+    def __init__(self, network, deviceType):
+        self.network = network
+        self.deviceType = deviceType
+    
+    def __call__(self, *inputs):
+        with torch.no_grad(), torch.autocast(device_type=self.deviceType, dtype=torch.bfloat16):
+            out = self.network(*inputs)
+        return out.float()
 
 class Actor(nn.Module):
-    """ Actor network model """
+    """
+    Actor network model
+    
+    Every parameter is on self.device by the time __init__ returns, so the optimizer can
+    be built straight from parameters() with the CUDA only options, e.g.
+    torch.optim.Adam(net.parameters(), fused=True, capturable=True). Fused Adam does the
+    whole step in a few kernels, and capturable keeps its step count on the GPU so the
+    step can be recorded in a CUDA graph together with the forward and backward passes
+    
+    With useCompile, compiledForward is a torch.compile version of forward for external
+    callers only: Agent and TD3Agent always call forward (or the scripted network).
+    It uses mode="reduce-overhead", so every call overwrites the CUDA graph outputs of
+    the previous one. A training step that calls compiled networks more than once has
+    to call torch.compiler.cudagraph_mark_step_begin() at its start and must not keep
+    outputs across calls without cloning them
+    """
+    
+    # The torch.compile handle is left out when the module is scripted
+    __jit_ignored_attributes__ = ['compiledForward']
     
-    def __init__(self, actionLims, state_size, action_size, seed, hiddenArray):
+    def __init__(self, actionLims, state_size, action_size, seed, hiddenArray, useCompile=False, rescaleInForward=True, \
+                 device: Optional[torch.device] = None):
         super(Actor, self).__init__()
-        self.seed = torch.manual_seed(seed)
+        # Only kept to seed the local generator in resetParameters, the global torch RNG is left alone
+        self.seed = seed
         self.stateSize = state_size
         self.actionSize = action_size
-        self.outputActivation = F.tanh
-        
-        # Set up for compute device
-        device = "cpu"
-        if torch.cuda.is_available():
-            device = "cuda:0"
-        self.device = torch.device(device)
-        self.to(self.device)
+        # When set, forward returns actions already rescaled to the environment limits
+        self.rescaleInForward = rescaleInForward
         
+        # Set up for compute device. The layers are created directly on it
+        self.device = torch.device(device) if device is not None else _DEFAULT_DEVICE
         
         # Calculate the action space min and max, and the
-        # network min and max for the action scaling function
-        self.env_min = torch.tensor(actionLims[0], device=self.device, dtype=torch.float32)
-        self.env_max = torch.tensor(actionLims[1], device=self.device, dtype=torch.float32)
-        self.nn_min = self.outputActivation(torch.Tensor([float('-inf')])).to(self.device)
-        self.nn_max = self.outputActivation(torch.Tensor([float('inf')])).to(self.device)
+        # network min and max for the action scaling function.
+        # They are buffers, so they follow the module through .to() and are saved with it
+        envMin = torch.tensor(actionLims[0], device=self.device, dtype=torch.float32)
+        envMax = torch.tensor(actionLims[1], device=self.device, dtype=torch.float32)
+        self.register_buffer('env_min', envMin)
+        self.register_buffer('env_max', envMax)
+        # The output activation is tanh, so the network limits are exactly -1 and 1
+        self.register_buffer('nn_min', torch.tensor(-1.0, device=self.device), persistent=False)
+        self.register_buffer('nn_max', torch.tensor(1.0, device=self.device), persistent=False)
+        
+        # The rescaling is affine, so its slope and offset are worked out once here.
+        # With the [-1, 1] tanh range they are the half width and the midpoint of the
+        # action limits. They are saved too, so they always match the loaded limits
+        self.register_buffer('_scale', (envMax - envMin) / 2.0)
+        self.register_buffer('_bias', (envMax + envMin) / 2.0)
+        
+        # Host buffer a single numpy state is copied into before it goes to the device.
+        # On the GPU it is page-locked so the copy is asynchronous, and an event marks
+        # when that copy is done so the buffer isn't overwritten too early
+        usePinned = self.device.type == 'cuda'
+        self._stateBuff = torch.empty(1, state_size, dtype=torch.float32, pin_memory=usePinned)
+        self._stateBuffEvent = torch.cuda.Event() if usePinned else None
+        
+        # CUDA graph of forward and its static tensors, set by captureGraph
+        self._graph = None
+        self._graphInputs = None
+        self._graphOutputs = None
         
         self.hiddenLayers = hiddenArray
         self.NeuralNet = None
-        self.output = None
         self.buildNetwork()
+        self.to(self.device)
         self.resetParameters()
         
+        # Checkpoints saved before the network was a single Sequential keep the output
+        # layer separately, so their keys are translated when they are loaded (older
+        # checkpoints also lack the action limit buffers, which are filled in)
+        self._register_load_state_dict_pre_hook(self._upgradeStateDict)
+        
+        # Optionally keep a torch.compile version of forward, so the Linear + ReLU chain is
+        # fused and the fixed-shape batches can be replayed as CUDA graphs. It is a separate
+        # handle called as net.compiledForward(state): forward itself stays eager, so
+        # script(), prepareForInference(), captureGraph() and quantizeForInference() all
+        # keep working on the plain module
+        self.compiledForward = None
+        if useCompile:
+            self.compiledForward = torch.compile(self.forward, mode="reduce-overhead", fullgraph=True)
+        
         
     def resetParameters(self):
         '''
         Resets the weights of the network.
         *functionName is a "methodcaller" operation in Python
         '''
-        for layer in self.NeuralNet:
-            layer.weight.data.uniform_(*hidden_init(layer))
-        self.output.weight.data.uniform_(-3e-3, 3e-3)
+        # A generator of its own, seeded the same way on every reset, so building a
+        # network doesn't disturb the global RNG (or any other network's draws)
+        generator = torch.Generator(device=next(self.parameters()).device).manual_seed(self.seed)
+        linearLayers = [layer for layer in self.NeuralNet if isinstance(layer, nn.Linear)]
+        # Xavier (Glorot) uniform for the hidden layers and small uniform values for the
+        # output layer, as in the DDPG paper
+        for layer in linearLayers[:-1]:
+            nn.init.xavier_uniform_(layer.weight, generator=generator)
+            nn.init.zeros_(layer.bias)
+        nn.init.uniform_(linearLayers[-1].weight, -3e-3, 3e-3, generator=generator)
+        nn.init.uniform_(linearLayers[-1].bias, -3e-3, 3e-3, generator=generator)
+    
+    def _upgradeStateDict(self, stateDict, prefix, *args):
+        '''
+        Renames the keys of a checkpoint saved with the old layout, where NeuralNet only held
+        the hidden Linear layers (NeuralNet.i) and the output layer was separate (output).
+        In the Sequential, the Linear layers sit at every other index between the ReLUs.
+        Checkpoints from before the action limits were saved get this network's limits
+        '''
+        for bufferName in ('env_min', 'env_max', '_scale', '_bias'):
+            stateDict.setdefault(prefix + bufferName, getattr(self, bufferName))
+        
+        if prefix + 'output.weight' not in stateDict:
+            return
+        
+        renamedKeys = {}
+        for key in stateDict:
+            if not key.startswith(prefix):
+                continue
+            layerName, _, paramName = key[len(prefix):].rpartition('.')
+            if layerName == 'output':
+                layerIdx = len(self.hiddenLayers)
+            elif layerName.startswith('NeuralNet.'):
+                layerIdx = int(layerName.split('.')[1])
+            else:
+                continue
+            renamedKeys[key] = '{}NeuralNet.{}.{}'.format(prefix, 2 * layerIdx, paramName)
+        
+        values = {newKey: stateDict.pop(oldKey) for oldKey, newKey in renamedKeys.items()}
+        stateDict.update(values)
     
     def rescaleAction(self, inputVal):
-        # Calculates  y = mx + b type scaling
-        print("rescale input")
-        print(inputVal)
-        return (inputVal - self.nn_min) * (self.env_max - self.env_min) / \
-                (self.nn_max - self.nn_min ) + self.env_min
+        # Calculates  y = mx + b type scaling, as a single fused multiply-add
+        return torch.addcmul(self._bias, inputVal, self._scale)
     
     def buildNetwork(self):
-        self.NeuralNet = nn.ModuleList([nn.Linear(self.stateSize, self.hiddenLayers[0])])
-        
-        layerSizes = zip(self.hiddenLayers[:-1], self.hiddenLayers[1:])
-        
-        self.NeuralNet.extend([nn.Linear(h1, h2) for h1, h2 in layerSizes])
-        self.output = nn.Linear(self.hiddenLayers[-1], self.actionSize)
-        self.resetParameters()
+        '''
+        The whole network is one nn.Sequential of Linear + ReLU pairs, finished by the
+        output Linear. The tanh activation is applied in forward, where it can be fused
+        with the action rescaling
+        '''
+        self.NeuralNet = _mlp([self.stateSize] + self.hiddenLayers + [self.actionSize], device=self.device)
     
-    def _format(self, state):
+    def formatState(self, state):
+        '''
+        Turns a single numpy state from the environment into a (1, stateSize) tensor on the
+        device. Tensors, e.g. replay batches, are passed through untouched.
+        This is kept out of forward, so forward stays a pure tensor function that can be
+        scripted or compiled; callers format the state before calling the network
+        '''
         x = state
         if not isinstance(x, torch.Tensor):
-            x = torch.tensor(x, device=self.device, dtype=torch.float32)
-            x = x.unsqueeze(0)
+            # Reuse the preallocated buffer instead of building a new tensor every step
+            if self._stateBuffEvent is not None:
+                self._stateBuffEvent.synchronize()
+            np.copyto(self._stateBuff.numpy(), np.reshape(x, (1, -1)))
+            x = self._stateBuff.to(self.device, non_blocking=True)
+            if self._stateBuffEvent is not None:
+                self._stateBuffEvent.record()
         return x
     
-    def forward(self, state):
-        x = self._format(state)
-        for linearLayer in self.NeuralNet:
-            x = F.relu(linearLayer(x))
-        x = self.outputActivation(self.output(x))
-        return x
+    def forward(self, state: torch.Tensor) -> torch.Tensor:
+        x = self.NeuralNet(state)
+        # Rescaling together with the tanh lets them run as one fused pointwise kernel
+        # instead of running rescaleAction as a separate call
+        if self.rescaleInForward:
+            return _tanh_rescale(x, self._scale, self._bias)
+        return torch.tanh(x)
+    
+    def script(self):
+        '''
+        Returns a warmed-up TorchScript version of the network for the action selection
+        path. It shares its parameters with this module, so it sees every training update
+        '''
+        dummyState = torch.zeros(1, self.stateSize, device=next(self.parameters()).device)
+        return _warmUp(torch.jit.script(self), dummyState)
+    
+    def prepareForInference(self):
+        '''
+        Returns a frozen TorchScript copy of the network for rollout workers that only
+        select actions. Unlike script(), it holds a snapshot of the weights
+        '''
+        dummyState = torch.zeros(1, self.stateSize, device=next(self.parameters()).device)
+        return _freezeForInference(self, (dummyState,))
+    
+    def captureGraph(self, exampleState):
+        '''
+        Records a no_grad forward pass at the batch size of exampleState into a CUDA graph,
+        so replay() runs the whole network as a single launch. Meant for passes that don't
+        need gradients at a fixed batch size, like the target network in the learn step.
+        The graph reads the live parameters, so it follows training updates
+        '''
+        assert next(self.parameters()).device.type == 'cuda', "CUDA graph capture needs the network on the GPU"
+        self._graph, self._graphInputs, self._graphOutputs = _captureGraph(self.forward, exampleState)
+    
+    def replay(self, state):
+        '''
+        Runs the captured graph on state, which must have the captured shape. The returned
+        tensor is overwritten by the next replay, so clone it if it has to be kept
+        '''
+        self._graphInputs[0].copy_(state)
+        self._graph.replay()
+        return self._graphOutputs
+    
+    def quantizeForInference(self):
+        '''
+        Returns a reduced precision version of the network for action selection only.
+        On the CPU it is a dynamically quantized int8 copy, a snapshot of the current
+        weights that has to be rebuilt to pick up later training updates. On the GPU it
+        wraps this network in bf16 autocast, so it shares the fp32 weights being trained
+        '''
+        paramDevice = next(self.parameters()).device
+        if paramDevice.type == 'cuda':
+            return _AutocastInference(self, paramDevice.type)
+        quantized = torch.ao.quantization.quantize_dynamic(self, {nn.Linear}, dtype=torch.qint8)
+        # The copy would otherwise keep the compiled forward of this fp32 network
+        quantized.compiledForward = None
+        return quantized.eval()
     
 class Critic(nn.Module):
-    """ Critic Network Model """
+    """
+    Critic Network Model
+    
+    Parameters are on self.device when __init__ returns, so fused / capturable Adam can
+    be used on them (see Actor)
+    
+    compiledForward (useCompile) is for external callers only, and the same reuse of
+    CUDA graph outputs applies (see Actor)
+    """
+    
+    __jit_ignored_attributes__ = ['compiledForward']
     
-    def __init__(self, state_size, action_size, seed, hiddenArray):
+    def __init__(self, state_size, action_size, seed, hiddenArray, useCompile=False, \
+                 device: Optional[torch.device] = None):
         super(Critic, self).__init__()
-        self.seed = torch.manual_seed(seed)
+        self.seed = seed
         self.stateSize = state_size
         self.actionSize = action_size
         self.hiddenLayers = hiddenArray
-        self.NeuralNet = None
-        self.output = None
+        
+        # Set up for compute device before building, so the layers are created on it
+        self.device = torch.device(device) if device is not None else _DEFAULT_DEVICE
+        
+        self.l0 = None
+        self.l1 = None
+        self.rest = None
         self.buildNetwork()
+        self.to(self.device)
         self.resetParameters()
         
-        # Set up for compute device
-        device = "cpu"
-        if torch.cuda.is_available():
-            device = "cuda:0"
-        self.device = torch.device(device)
-        self.to(self.device)
+        # Checkpoints saved while the hidden layers were one ModuleList are translated
+        # to the l0 / l1 / rest layout when they are loaded
+        self._register_load_state_dict_pre_hook(self._upgradeStateDict)
+        
+        # Optional torch.compile handle for forward (see Actor)
+        self.compiledForward = None
+        if useCompile:
+            self.compiledForward = torch.compile(self.forward, mode="reduce-overhead", fullgraph=True)
     
     def resetParameters(self):
         '''
         Resets the weights of the network.
         *functionName is a "methodcaller" operation in Python
         '''
-        for layer in self.NeuralNet:
-            layer.weight.data.uniform_(*hidden_init(layer))
-        self.output.weight.data.uniform_(-3e-3, 3e-3)
+        # Local generator, see Actor
+        generator = torch.Generator(device=next(self.parameters()).device).manual_seed(self.seed)
+        linearLayers = [self.l0, self.l1] + [layer for layer in self.rest if isinstance(layer, nn.Linear)]
+        for layer in linearLayers[:-1]:
+            nn.init.xavier_uniform_(layer.weight, generator=generator)
+            nn.init.zeros_(layer.bias)
+        nn.init.uniform_(linearLayers[-1].weight, -3e-3, 3e-3, generator=generator)
+        nn.init.uniform_(linearLayers[-1].bias, -3e-3, 3e-3, generator=generator)
+    
+    def _upgradeStateDict(self, stateDict, prefix, *args):
+        '''
+        Renames the keys of a checkpoint saved with the old layout, where every hidden layer
+        was an entry of the NeuralNet ModuleList and the output layer was separate (output).
+        Layers past the second one, output included, live in the rest Sequential at every
+        other index between the ReLUs
+        '''
+        renamedKeys = {}
+        for key in stateDict:
+            if key.startswith(prefix + 'NeuralNet.'):
+                _, layerIdx, paramName = key[len(prefix):].split('.')
+                layerIdx = int(layerIdx)
+            elif key.startswith(prefix + 'output.'):
+                _, paramName = key[len(prefix):].split('.')
+                layerIdx = len(self.hiddenLayers)
+            else:
+                continue
+            if layerIdx < 2:
+                layerName = 'l{}'.format(layerIdx)
+            else:
+                layerName = 'rest.{}'.format(2 * (layerIdx - 2))
+            renamedKeys[key] = '{}{}.{}'.format(prefix, layerName, paramName)
+        
+        values = {newKey: stateDict.pop(oldKey) for oldKey, newKey in renamedKeys.items()}
+        stateDict.update(values)
     
     def buildNetwork(self):
         '''
@@ -127,28 +393,68 @@ class Critic(nn.Module):
         Problems might also occur if we try to normalize the input and action spaces. If they
         are drastically different, performing the same normilzation on both, then contantenation
         might be undesirable.
+        The first two layers are kept apart (l0 sees the state, l1 also takes the actions) and
+        the remaining layers, output included, form one Sequential, so forward has no
+        per-layer branching
         '''
-        self.NeuralNet = nn.ModuleList([nn.Linear(self.stateSize, self.hiddenLayers[0])])
-        layerSizes = [item for item in zip(self.hiddenLayers[:-1], self.hiddenLayers[1:])]
-
+        assert len(self.hiddenLayers) >= 2, "Critic needs at least two hidden layers"
+        self.l0 = nn.Linear(self.stateSize, self.hiddenLayers[0], device=self.device)
+        self.l1 = nn.Linear(self.hiddenLayers[0] + self.actionSize, self.hiddenLayers[1], device=self.device)
+        self.rest = _mlp(self.hiddenLayers[1:] + [1], device=self.device)
+    
+    def forward(self, state: torch.Tensor, action: torch.Tensor) -> torch.Tensor:
+        x = F.relu(self.l0(state))
         
-        for idx in range(len(layerSizes)):
-            if idx == 0:
-                self.NeuralNet.extend([nn.Linear(layerSizes[idx][0] + self.actionSize, layerSizes[idx][1])])      
-            else:
-                self.NeuralNet.extend([nn.Linear(layerSizes[idx][0], layerSizes[idx][1])])
-        self.output = nn.Linear(self.hiddenLayers[-1], 1)
-                              
-    
-    def forward(self,state, action):
-        for layerIdx in range(len(self.NeuralNet)):
-            if layerIdx == 0:
-                x = F.relu(self.NeuralNet[layerIdx](state))
-            else:
-                if layerIdx == 1:
-                    x = torch.cat((x, action), dim=1)
-                x = F.relu(self.NeuralNet[layerIdx](x))
-        return self.output(x)
+        # The actions are concatenated in at l1. The concatenation is only batch x
+        # (hidden + action) wide, which is cheaper than splitting l1's weight: each weight
+        # slice would allocate a full size gradient in the backward pass
+        x = F.relu(self.l1(torch.cat((x, action), dim=1)))
+        
+        return self.rest(x)
+    
+    def script(self):
+        '''
+        Returns a warmed-up TorchScript version of the network that shares its parameters
+        '''
+        paramDevice = next(self.parameters()).device
+        dummyState = torch.zeros(1, self.stateSize, device=paramDevice)
+        dummyAction = torch.zeros(1, self.actionSize, device=paramDevice)
+        return _warmUp(torch.jit.script(self), dummyState, dummyAction)
+    
+    def prepareForInference(self):
+        '''
+        Returns a frozen TorchScript copy of the network (see Actor.prepareForInference)
+        '''
+        paramDevice = next(self.parameters()).device
+        dummyState = torch.zeros(1, self.stateSize, device=paramDevice)
+        dummyAction = torch.zeros(1, self.actionSize, device=paramDevice)
+        return _freezeForInference(self, (dummyState, dummyAction))
+
+class TwinLinear(nn.Module):
+    '''
+    A pair of Linear layers of the same shape, one per twin, stored as a single
+    (2, out, in) weight and (2, out) bias. The input is (n, batch, in) with n = 2 to
+    run both twins in one batched matmul, or n = 1 to run only the first one
+    '''
+    
+    def __init__(self, in_features, out_features, device=None):
+        super(TwinLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(2, out_features, in_features, device=device))
+        self.bias = nn.Parameter(torch.empty(2, out_features, device=device))
+        self.resetParameters()
+    
+    def resetParameters(self):
+        # Same default initialization as nn.Linear, done separately for each twin
+        bound = 1.0 / np.sqrt(self.in_features)
+        for twinIdx in range(2):
+            nn.init.kaiming_uniform_(self.weight.data[twinIdx], a=np.sqrt(5))
+            self.bias.data[twinIdx].uniform_(-bound, bound)
+    
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        n = x.shape[0]
+        return torch.baddbmm(self.bias[:n].unsqueeze(1), x, self.weight[:n].transpose(1, 2))
 
 class TD3Critic(nn.Module):
     '''
@@ -156,91 +462,152 @@ class TD3Critic(nn.Module):
     separate yet architecturally identical networks called Twins.
     The losses of both twins are combined and used to optimize both
     networks.
+    Like the other networks, the parameters are on self.device once __init__ returns,
+    which fused / capturable Adam requires (see Actor)
+    compiledForward and compiledForwardNetA (useCompile) are for external callers only.
+    TD3Agent.learn calls the local critic twice per step, so code that switches to these
+    handles needs torch.compiler.cudagraph_mark_step_begin() each step (see Actor)
     '''
     
-    def __init__(self, state_size, action_size, seed, hiddenArray):
+    __jit_ignored_attributes__ = ['compiledForward', 'compiledForwardNetA']
+    
+    def __init__(self, state_size, action_size, seed, hiddenArray, useCompile=False, \
+                 device: Optional[torch.device] = None):
         super(TD3Critic, self).__init__()
-        self.seed = torch.manual_seed(seed)
+        self.seed = seed
         self.stateSize = state_size
         self.actionSize = action_size
         self.hiddenLayers = hiddenArray
-        self.NeuralNetA = None
-        self.NeuralNetB = None
-        self.outputA = None
-        self.outputB = None
+        
+        # Set up for compute device before building, so the layers are created on it
+        self.device = torch.device(device) if device is not None else _DEFAULT_DEVICE
+        
+        self.NeuralNet = None
         self.buildNetworks()
+        self.to(self.device)
         self.resetParameters()
         
-        device = "cpu"
-        if torch.cuda.is_available():
-            device = "cuda:0"
-        self.device = torch.device(device)
-        self.to(self.device)
-    
-    def buildNetworks(self):
-        self.NeuralNetA = nn.ModuleList([nn.Linear(self.stateSize + \
-                                                   self.actionSize, self.hiddenLayers[0])])
-        self.NeuralNetB = nn.ModuleList([nn.Linear(self.stateSize + \
-                                                   self.actionSize, self.hiddenLayers[0])])
+        # Checkpoints saved with separate A and B networks are stacked into the twin
+        # layers when they are loaded
+        self._register_load_state_dict_pre_hook(self._upgradeStateDict)
         
-        for i in range(len(self.hiddenLayers) - 1):
-            self.NeuralNetA.extend([nn.Linear(self.hiddenLayers[i], self.hiddenLayers[i + 1])])
-            self.NeuralNetB.extend([nn.Linear(self.hiddenLayers[i], self.hiddenLayers[i + 1])])
+        # CUDA graph of forward and its static tensors, set by captureGraph
+        self._graph = None
+        self._graphInputs = None
+        self._graphOutputs = None
         
-        self.outputA = nn.Linear(self.hiddenLayers[-1], 1)
-        self.outputB = nn.Linear(self.hiddenLayers[-1], 1)
+        # Optional torch.compile handles for forward and forwardNetA (see Actor)
+        self.compiledForward = None
+        self.compiledForwardNetA = None
+        if useCompile:
+            self.compiledForward = torch.compile(self.forward, mode="reduce-overhead", fullgraph=True)
+            self.compiledForwardNetA = torch.compile(self.forwardNetA, mode="reduce-overhead", fullgraph=True)
+    
+    def buildNetworks(self):
+        '''
+        The twins are built side by side: every layer is a TwinLinear holding the A and B
+        weights together, so each layer of both networks is a single batched matmul
+        '''
+        self.NeuralNet = _mlp([self.stateSize + self.actionSize] + self.hiddenLayers + [1], \
+                              layer=TwinLinear, device=self.device)
     
     def resetParameters(self):
         '''
         Resets the weights of the network.
         *functionName is a "methodcaller" operation in Python
         '''
-        for layer in self.NeuralNetA:
-            layer.weight.data.uniform_(*hidden_init(layer))
-        self.outputA.weight.data.uniform_(-3e-3, 3e-3)
-        
-        for layer in self.NeuralNetB:
-            layer.weight.data.uniform_(*hidden_init(layer))
-        self.outputB.weight.data.uniform_(-3e-3, 3e-3)
+        # Local generator, see Actor
+        generator = torch.Generator(device=next(self.parameters()).device).manual_seed(self.seed)
+        twinLayers = [layer for layer in self.NeuralNet if isinstance(layer, TwinLinear)]
+        for layer in twinLayers[:-1]:
+            # Each twin's slice is initialized on its own, xavier_uniform_ would
+            # otherwise count the twin dimension into the fans
+            for twinIdx in range(2):
+                nn.init.xavier_uniform_(layer.weight.data[twinIdx], generator=generator)
+            nn.init.zeros_(layer.bias)
+        nn.init.uniform_(twinLayers[-1].weight, -3e-3, 3e-3, generator=generator)
+        nn.init.uniform_(twinLayers[-1].bias, -3e-3, 3e-3, generator=generator)
     
-    def _format(self, state, action):
-        x, u = state, action
-        if not isinstance(x, torch.Tensor):
-            x = torch.tensor(x, device=self.device, dtype=torch.float32)
-            x = x.unsqueeze(0)
-        if not isinstance(u, torch.Tensor):
-            u = torch.tensor(u, device=self.device, dtype=torch.float32)
-            u = u.unsqueeze(0)
-        return x, u
-    
-    def forward(self, state, action):
-        x_a = torch.cat((state, action), dim=1)
-        x_b = torch.cat((state, action), dim=1)
-        
-        for layerIdx_a in range(len(self.NeuralNetA)):
-                x_a = F.relu(self.NeuralNetA[layerIdx_a](x_a))
-        
-        for layerIdx_b in range(len(self.NeuralNetB)):
-                x_b = F.relu(self.NeuralNetB[layerIdx_b](x_b))
+    def _upgradeStateDict(self, stateDict, prefix, *args):
+        '''
+        Converts a checkpoint saved with the old layout, where the twins were the separate
+        NeuralNetA.i / NeuralNetB.i and outputA / outputB layers. Each pair of A and B
+        tensors is stacked into the matching TwinLinear parameter of NeuralNet
+        '''
+        if prefix + 'outputA.weight' not in stateDict:
+            return
         
-        x_a = self.outputA(x_a)
-        x_b = self.outputB(x_b)
+        layerNames = ['NeuralNet{}.' + str(i) for i in range(len(self.hiddenLayers))] + ['output{}']
+        newNames = ['NeuralNet.' + str(2 * i) for i in range(len(self.hiddenLayers) + 1)]
+        for layerName, newName in zip(layerNames, newNames):
+            for paramName in ('weight', 'bias'):
+                keyA = prefix + layerName.format('A') + '.' + paramName
+                keyB = prefix + layerName.format('B') + '.' + paramName
+                stateDict[prefix + newName + '.' + paramName] = \
+                    torch.stack((stateDict.pop(keyA), stateDict.pop(keyB)))
+    
+    def forward(self, state: torch.Tensor, action: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # The critic is only evaluated on replay batches, which are already float tensors
+        # on the device, so the inputs are used as they are
+        # Both twins see the same input, so it is concatenated once and broadcast
+        # (without a copy) to the (2, batch, in) shape the twin layers expect
+        x = torch.cat((state, action), dim=1)
+        q = self.NeuralNet(x.expand(2, -1, -1))
         
-        return x_a, x_b
+        return q[0], q[1]
     
-    def forwardNetA(self, state, action):
+    @torch.jit.export
+    def forwardNetA(self, state: torch.Tensor, action: torch.Tensor) -> torch.Tensor:
         '''
         Used to perform a forward pass only through the A network. This is
-        useful for getting target Q-values for Actor (policy) updates
+        useful for getting target Q-values for Actor (policy) updates.
+        Exported so it is compiled along with forward when the module is scripted.
+        Like forward, it takes batched tensors already on the device
         '''
-        x, u = self._format(state, action)
-        x_a = torch.cat((x, u), dim=1)
-        
-        for layerIdx_a in range(len(self.NeuralNetA)):
-                x_a = F.relu(self.NeuralNetA[layerIdx_a](x_a))
+        x_a = torch.cat((state, action), dim=1)
         
-        x_a = self.outputA(x_a)
+        # A single twin slice makes the twin layers only use the A weights
+        q_a = self.NeuralNet(x_a.unsqueeze(0))
         
-        return x_a
+        return q_a[0]
+    
+    def script(self):
+        '''
+        Returns a warmed-up TorchScript version of the network that shares its parameters.
+        forwardNetA is compiled along with forward
+        '''
+        paramDevice = next(self.parameters()).device
+        dummyState = torch.zeros(1, self.stateSize, device=paramDevice)
+        dummyAction = torch.zeros(1, self.actionSize, device=paramDevice)
+        return _warmUp(torch.jit.script(self), dummyState, dummyAction)
+    
+    def prepareForInference(self):
+        '''
+        Returns a frozen TorchScript copy of the network (see Actor.prepareForInference).
+        forwardNetA is kept in the frozen module as well
+        '''
+        paramDevice = next(self.parameters()).device
+        dummyState = torch.zeros(1, self.stateSize, device=paramDevice)
+        dummyAction = torch.zeros(1, self.actionSize, device=paramDevice)
+        return _freezeForInference(self, (dummyState, dummyAction), preservedMethods=('forwardNetA',))
+    
+    def captureGraph(self, exampleState, exampleAction):
+        '''
+        Records a no_grad pass through both twins into a CUDA graph (see Actor.captureGraph),
+        e.g. for the target Q-values, which are computed at the same batch size every step
+        '''
+        assert next(self.parameters()).device.type == 'cuda', "CUDA graph capture needs the network on the GPU"
+        self._graph, self._graphInputs, self._graphOutputs = \
+            _captureGraph(self.forward, exampleState, exampleAction)
+    
+    def replay(self, state, action):
+        '''
+        Runs the captured graph and returns both twins' Q-values. They are overwritten by
+        the next replay
+        '''
+        self._graphInputs[0].copy_(state)
+        self._graphInputs[1].copy_(action)
+        self._graph.replay()
+        return self._graphOutputs
                                          
     
\ No newline at end of file
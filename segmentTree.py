@@ -0,0 +1,109 @@
+'''
+Segment trees used by the Prioritized Replay Buffer. Each tree is kept as a flat
+array of size 2 * capacity with the root at index 1 and the leaves starting at
+index capacity, so the update and search loops can be compiled with Numba
+'''
+
+import numpy as np
+from numba import njit
+
+@njit(cache=True)
+def _sumTreeSet(tree, capacity, idx, value):
+    # Set the leaf, then walk up the parent chain re-summing the children
+    pos = idx + capacity
+    tree[pos] = value
+    pos //= 2
+    while pos >= 1:
+        tree[pos] = tree[2 * pos] + tree[2 * pos + 1]
+        pos //= 2
+
+@njit(cache=True)
+def _minTreeSet(tree, capacity, idx, value):
+    # Set the leaf, then walk up the parent chain taking the smaller child
+    pos = idx + capacity
+    tree[pos] = value
+    pos //= 2
+    while pos >= 1:
+        tree[pos] = min(tree[2 * pos], tree[2 * pos + 1])
+        pos //= 2
+
+@njit(cache=True)
+def _updateTrees(sumTree, minTree, capacity, idxes, values):
+    for i in range(idxes.shape[0]):
+        _sumTreeSet(sumTree, capacity, idxes[i], values[i])
+        _minTreeSet(minTree, capacity, idxes[i], values[i])
+
+@njit(cache=True)
+def _findPrefixsumIdx(tree, capacity, prefixsums, result):
+    for i in range(prefixsums.shape[0]):
+        prefixsum = prefixsums[i]
+        pos = 1
+        # Descend from the root, going right whenever the left subtree sums to less than
+        # what is left of the prefix sum
+        while pos < capacity:
+            if tree[2 * pos] > prefixsum:
+                pos = 2 * pos
+            else:
+                prefixsum -= tree[2 * pos]
+                pos = 2 * pos + 1
+        result[i] = pos - capacity
+
+class SumSegmentTree():
+    '''
+    Segment tree holding the sum of the priorities
+
+    Methods
+    sum: total of every leaf in the tree
+    find_prefixsum_idx: leaf indexes at which the running sum reaches each of the given masses
+    '''
+
+    def __init__(self, capacity):
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be a power of 2"
+        self.capacity = capacity
+        self.tree = np.zeros(2 * capacity, dtype=np.float64)
+
+    def __setitem__(self, idx, value):
+        _sumTreeSet(self.tree, self.capacity, idx, value)
+
+    def __getitem__(self, idx):
+        # Works with a single index or an array of indexes
+        return self.tree[self.capacity + idx]
+
+    def sum(self):
+        return self.tree[1]
+
+    def find_prefixsum_idx(self, prefixsums):
+        prefixsums = np.asarray(prefixsums, dtype=np.float64)
+        result = np.empty(prefixsums.shape[0], dtype=np.int64)
+        _findPrefixsumIdx(self.tree, self.capacity, prefixsums, result)
+        return result
+
+class MinSegmentTree():
+    '''
+    Segment tree holding the minimum of the priorities
+
+    Methods
+    min: smallest leaf in the tree
+    '''
+
+    def __init__(self, capacity):
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be a power of 2"
+        self.capacity = capacity
+        self.tree = np.full(2 * capacity, float('inf'), dtype=np.float64)
+
+    def __setitem__(self, idx, value):
+        _minTreeSet(self.tree, self.capacity, idx, value)
+
+    def __getitem__(self, idx):
+        return self.tree[self.capacity + idx]
+
+    def min(self):
+        return self.tree[1]
+
+def updateTrees(sumTree, minTree, idxes, values):
+    '''
+    Set the same leaves of a sum tree and a min tree in a single compiled call
+    '''
+    assert sumTree.capacity == minTree.capacity
+    _updateTrees(sumTree.tree, minTree.tree, sumTree.capacity, \
+                 np.asarray(idxes, dtype=np.int64), np.asarray(values, dtype=np.float64))